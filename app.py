@@ -2,6 +2,8 @@ import datetime
 
 import requests
 import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # FastAPI server details
 API_URL = "http://127.0.0.1:8000/chat"
@@ -9,9 +11,24 @@ START_CONVERSATION_URL = "http://127.0.0.1:8000/start_conversation"
 ALL_CONVERSATIONS_URL = "http://127.0.0.1:8000/all_conversations"
 HISTORY_URL = "http://127.0.0.1:8000/history"
 STATUS_URL = "http://127.0.0.1:8000/status"
+# Sent by the server when a /chat stream fails after it started, followed by the error message
+STREAM_ERROR_MARKER = "\x1e"
 # Retry parameters
-RETRY_TIMEOUT = 10  # Total timeout in seconds
-RETRY_ATTEMPTS = 5  # Interval between retries in seconds
+RETRY_TIMEOUT = 10  # Timeout of each request in seconds
+RETRY_ATTEMPTS = 5  # Number of retries on failed connections, with exponential backoff
+
+
+# Shared HTTP session so that consecutive calls reuse pooled keep-alive connections.
+# Cached as a resource because Streamlit re-runs this script on every interaction
+@st.cache_resource
+def get_session():
+	session = requests.Session()
+	session.mount("http://", HTTPAdapter(
+		pool_connections=10,
+		pool_maxsize=10,
+		max_retries=Retry(total=RETRY_ATTEMPTS, backoff_factor=0.5)
+	))
+	return session
 
 
 # Generate a localized welcome message
@@ -23,7 +40,7 @@ def generate_welcome_message():
 # Function to start a new conversation
 def start_new_conversation():
 	try:
-		response = requests.post(START_CONVERSATION_URL)
+		response = get_session().post(START_CONVERSATION_URL, timeout=RETRY_TIMEOUT)
 		response.raise_for_status()
 		return response.json().get("conversation_id")
 	except requests.exceptions.RequestException:
@@ -34,7 +51,7 @@ def start_new_conversation():
 # Function to fetch all conversations
 def fetch_all_conversations():
 	try:
-		response = requests.get(ALL_CONVERSATIONS_URL)
+		response = get_session().get(ALL_CONVERSATIONS_URL, timeout=RETRY_TIMEOUT)
 		response.raise_for_status()
 		return response.json().get("conversations", [])
 	except requests.exceptions.RequestException:
@@ -45,7 +62,7 @@ def fetch_all_conversations():
 # Function to fetch a conversation history
 def fetch_conversation_history(conversation_id):
 	try:
-		response = requests.get(f"{HISTORY_URL}/{conversation_id}")
+		response = get_session().get(f"{HISTORY_URL}/{conversation_id}", timeout=RETRY_TIMEOUT)
 		response.raise_for_status()
 		return response.json().get("history", [])
 	except requests.exceptions.RequestException:
@@ -53,19 +70,31 @@ def fetch_conversation_history(conversation_id):
 		return []
 
 
-# Function to send a user message to the server
+# Function to send a user message to the server and stream back the response
 def query_fastapi(user_message, conversation_id):
+	streamed = False
 	try:
 		payload = {
 			"conversation_id": conversation_id,
-			"user_message": user_message,
-			"messages": st.session_state.messages
+			"user_message": user_message
 		}
-		response = requests.post(API_URL, json=payload)
-		response.raise_for_status()
-		return response.json().get("response", "No response from server.")
+		# Only bound the connect phase, LLM completions may take longer than RETRY_TIMEOUT
+		with get_session().post(API_URL, json=payload, timeout=(RETRY_TIMEOUT, None), stream=True) as response:
+			response.raise_for_status()
+			for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+				content, marker, _ = chunk.partition(STREAM_ERROR_MARKER)
+				if content:
+					streamed = True
+					yield content
+				if marker:
+					st.error("The response was interrupted. Please try again.")
+					return
 	except requests.exceptions.RequestException:
-		return "I'm having trouble connecting to the server. Please try again later."
+		# Keep a partial answer apart from the error, so it is not stored as part of the response
+		if streamed:
+			st.error("The connection to the server was interrupted. Please try again.")
+		else:
+			yield "I'm having trouble connecting to the server. Please try again later."
 
 
 # Initialize session state
@@ -121,11 +150,12 @@ if st.session_state.conversation_id:
 		st.session_state.messages.append({"role": "user", "content": user_input})
 		st.chat_message("user").write(user_input)
 
-		# Query the FastAPI server
-		assistant_response = query_fastapi(user_input, st.session_state.conversation_id)
+		# Query the FastAPI server, writing the response as it is streamed
+		assistant_response = st.chat_message("assistant").write_stream(
+			query_fastapi(user_input, st.session_state.conversation_id)
+		)
 
-		# Add assistant message to chat history
-		st.session_state.messages.append({"role": "assistant", "content": assistant_response})
-		st.chat_message("assistant").write(assistant_response)
+		# Add assistant message to chat history, write_stream returns an empty list if nothing was streamed
+		st.session_state.messages.append({"role": "assistant", "content": assistant_response or ""})
 else:
 	st.write("Initializing a new conversation...")
@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import hnswlib
+import numpy as np
+
+
+class SemanticCache:
+	"""Cache of assistant responses keyed by the embedding of the user query.
+
+	Nearest-neighbour lookups go through an HNSW index, so they stay fast as the cache grows.
+	The cache is safe to use from several threads.
+	"""
+
+	def __init__(self, threshold: float = 0.92, ttl: float = 3600, max_elements: int = 100000):
+		self.threshold = threshold
+		self.ttl = ttl
+		self.max_elements = max_elements
+		self.index: Optional[hnswlib.Index] = None
+		self.responses: Dict[int, str] = {}
+		self.expires_at: Dict[int, float] = {}
+		self.next_label = 0
+		self.next_purge = time.time() + ttl
+		# Serializes access to the HNSW index and the entry dicts, hnswlib does not guard
+		# knn_query against concurrent add_items, resize_index or mark_deleted calls
+		self.lock = threading.Lock()
+
+	def _init_index(self, dim: int):
+		self.index = hnswlib.Index(space="cosine", dim=dim)
+		# Slots of evicted entries are reused by later additions
+		self.index.init_index(max_elements=self.max_elements, ef_construction=200, M=16, allow_replace_deleted=True)
+
+	def _evict(self, label: int):
+		self.index.mark_deleted(label)
+		del self.responses[label]
+		del self.expires_at[label]
+
+	def _purge_expired(self):
+		now = time.time()
+		for label in [label for label, t in self.expires_at.items() if t <= now]:
+			self._evict(label)
+		self.next_purge = now + self.ttl
+
+	def lookup(self, embedding) -> Optional[str]:
+		"""Return the cached response of the most similar query, if it is similar enough."""
+		embedding = np.asarray(embedding, dtype=np.float32)
+		with self.lock:
+			if self.next_purge <= time.time():
+				self._purge_expired()
+			if not self.responses:
+				return None
+			if embedding.shape[-1] != self.index.dim:
+				raise ValueError(f"Expected a query embedding of dimension {self.index.dim}, got {embedding.shape[-1]}.")
+			labels, distances = self.index.knn_query(embedding, k=1)
+			label = int(labels[0][0])
+			if self.expires_at[label] <= time.time():
+				self._evict(label)
+				return None
+			if 1 - distances[0][0] >= self.threshold:
+				return self.responses[label]
+			return None
+
+	def add(self, embedding, response: str):
+		"""Store a response for the given query embedding."""
+		embedding = np.asarray(embedding, dtype=np.float32)
+		with self.lock:
+			if self.index is None:
+				self._init_index(embedding.shape[-1])
+			if self.next_purge <= time.time() or self.index.get_current_count() >= self.index.get_max_elements():
+				self._purge_expired()
+			if len(self.responses) >= self.index.get_max_elements():
+				self.index.resize_index(2 * self.index.get_max_elements())
+			label = self.next_label
+			# Only record the entry once the index accepted it, lookups hold the lock so they
+			# cannot see the label before its entry is filled in
+			self.index.add_items(embedding, label, replace_deleted=True)
+			self.next_label += 1
+			self.responses[label] = response
+			self.expires_at[label] = time.time() + self.ttl
+
+	def save(self, persist_dir: str, fingerprint: str):
+		"""Persist the HNSW index and the cached responses to disk.
+
+		The fingerprint identifies the embedding setup the cached queries were embedded with.
+		"""
+		with self.lock:
+			if self.index is None:
+				return
+			self._purge_expired()
+			os.makedirs(persist_dir, exist_ok=True)
+			self.index.save_index(os.path.join(persist_dir, "index.bin"))
+			with open(os.path.join(persist_dir, "entries.json"), "w", encoding="utf-8") as f:
+				json.dump({
+					"fingerprint": fingerprint,
+					"dim": self.index.dim,
+					"next_label": self.next_label,
+					"responses": self.responses,
+					"expires_at": self.expires_at,
+				}, f, ensure_ascii=False)
+
+	def load(self, persist_dir: str, fingerprint: str):
+		"""Restore a cache previously stored with `save`, if one exists for the same fingerprint."""
+		entries_path = os.path.join(persist_dir, "entries.json")
+		if not os.path.exists(entries_path):
+			return
+		with open(entries_path, encoding="utf-8") as f:
+			entries = json.load(f)
+		# Responses cached for another embedding model or corpus are discarded
+		if entries.get("fingerprint") != fingerprint:
+			return
+		index = hnswlib.Index(space="cosine", dim=entries["dim"])
+		index.load_index(
+			os.path.join(persist_dir, "index.bin"), max_elements=self.max_elements, allow_replace_deleted=True
+		)
+		with self.lock:
+			self.index = index
+			self.next_label = entries["next_label"]
+			self.responses = {int(label): r for label, r in entries["responses"].items()}
+			self.expires_at = {int(label): t for label, t in entries["expires_at"].items()}
+			# Entries may have expired while the server was down
+			self._purge_expired()
@@ -0,0 +1,86 @@
+from typing import Any, List, Optional, Sequence
+
+import torch
+import torch.nn.functional as F
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.node_parser import SemanticSplitterNodeParser
+from llama_index.core.node_parser.node_utils import build_nodes_from_splits
+from llama_index.core.schema import BaseNode
+from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+
+def preferred_dtype() -> torch.dtype:
+	"""Half precision dtype to load the embedding model with on GPU, full precision on CPU."""
+	if not torch.cuda.is_available():
+		return torch.float32
+	return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+
+class BatchedHuggingFaceEmbedding(HuggingFaceEmbedding):
+	"""HuggingFaceEmbedding that tokenizes all inputs in a single call and only slices the forward pass into batches."""
+
+	forward_batch_size: int = Field(default=128, description="The batch size of each model forward pass.", gt=0)
+
+	def __init__(self, forward_batch_size: int = 128, **kwargs: Any):
+		super().__init__(**kwargs)
+		self.forward_batch_size = forward_batch_size
+
+	@classmethod
+	def class_name(cls) -> str:
+		return "BatchedHuggingFaceEmbedding"
+
+	def _embed(self, sentences: List[str], prompt_name: Optional[str] = None) -> List[List[float]]:
+		if isinstance(sentences, str):
+			return self._embed([sentences], prompt_name)[0]
+		if self._parallel_process:
+			return super()._embed(sentences, prompt_name)
+
+		prompt = (self._model.prompts.get(prompt_name) or "") if prompt_name else ""
+		# Sort by length so that every forward batch carries as little padding as possible
+		order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]), reverse=True)
+		tokenizer = self._model.tokenizer
+		encoded = tokenizer(
+			[prompt + sentences[i] for i in order], truncation=True, max_length=self._model.max_seq_length
+		)
+
+		embeddings: List[Optional[List[float]]] = [None] * len(sentences)
+		with torch.inference_mode():
+			for start in range(0, len(order), self.forward_batch_size):
+				end = start + self.forward_batch_size
+				features = tokenizer.pad({k: v[start:end] for k, v in encoded.items()}, return_tensors="pt")
+				features = {k: v.to(self._model.device) for k, v in features.items()}
+				features = self._model[0](features)
+				# Upcast the hidden states of half precision models before pooling and normalization
+				features["token_embeddings"] = features["token_embeddings"].float()
+				for module in list(self._model)[1:]:
+					features = module(features)
+				batch_embeddings = features["sentence_embedding"]
+				if self.normalize:
+					batch_embeddings = F.normalize(batch_embeddings, p=2, dim=1)
+				for i, embedding in zip(order[start:end], batch_embeddings.float().cpu().tolist()):
+					embeddings[i] = embedding
+		return embeddings
+
+
+class BatchedSemanticSplitterNodeParser(SemanticSplitterNodeParser):
+	"""SemanticSplitterNodeParser that embeds the sentence groups of all given documents in one batch."""
+
+	@classmethod
+	def class_name(cls) -> str:
+		return "BatchedSemanticSplitterNodeParser"
+
+	def _parse_nodes(self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any) -> List[BaseNode]:
+		doc_sentences = [self._build_sentence_groups(self.sentence_splitter(node.text)) for node in nodes]
+		embeddings = iter(self.embed_model.get_text_embedding_batch(
+			[s["combined_sentence"] for sentences in doc_sentences for s in sentences],
+			show_progress=show_progress,
+		))
+
+		all_nodes: List[BaseNode] = []
+		for node, sentences in zip(nodes, doc_sentences):
+			for sentence in sentences:
+				sentence["combined_sentence_embedding"] = next(embeddings)
+			distances = self._calculate_distances_between_sentence_groups(sentences)
+			chunks = self._build_node_chunks(sentences, distances)
+			all_nodes.extend(build_nodes_from_splits(chunks, node, id_func=self.id_func))
+		return all_nodes
@@ -0,0 +1,47 @@
+import sqlite3
+from typing import Dict, List, NamedTuple, Tuple
+
+
+class StoredMessage(NamedTuple):
+	"""Compact in-memory representation of a message in a conversation history."""
+	role: str
+	content: str
+
+
+class HistoryStore:
+	"""SQLite store that persists conversations and their messages across restarts."""
+
+	def __init__(self, path: str):
+		# Writes happen in worker threads, one batch at a time
+		self.connection = sqlite3.connect(path, check_same_thread=False)
+		self.connection.executescript("""
+			CREATE TABLE IF NOT EXISTS conversations (id TEXT PRIMARY KEY, start_time REAL NOT NULL);
+			CREATE TABLE IF NOT EXISTS messages (conversation_id TEXT NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL);
+		""")
+
+	def load(self) -> Dict[str, Dict]:
+		"""Return all stored conversations keyed by conversation ID."""
+		conversations = {
+			conversation_id: {"id": conversation_id, "start_time": start_time, "messages": []}
+			for conversation_id, start_time in self.connection.execute("SELECT id, start_time FROM conversations")
+		}
+		# Messages whose conversation row was lost in a failed write batch are skipped
+		for conversation_id, role, content in self.connection.execute(
+			"SELECT m.conversation_id, m.role, m.content FROM messages m "
+			"JOIN conversations c ON c.id = m.conversation_id ORDER BY m.rowid"
+		):
+			conversations[conversation_id]["messages"].append(StoredMessage(role, content))
+		return conversations
+
+	def write(self, conversations: List[Tuple[str, float]], messages: List[Tuple[str, str, str]]):
+		"""Insert a batch of conversations and messages in a single transaction.
+
+		Conversations that are already stored are ignored, so a batch can carry the conversation
+		rows of all its messages and restore any lost by an earlier failed batch.
+		"""
+		with self.connection:
+			self.connection.executemany("INSERT OR IGNORE INTO conversations VALUES (?, ?)", conversations)
+			self.connection.executemany("INSERT INTO messages VALUES (?, ?, ?)", messages)
+
+	def close(self):
+		self.connection.close()
@@ -1,20 +1,46 @@
+import asyncio
+import functools
+import hashlib
 import os
 import time
 import uuid
 from contextlib import asynccontextmanager
-from typing import List, Dict, Union, Generator
+from itertools import chain
+from typing import List, Dict, Iterator, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
-from llama_index.core import VectorStoreIndex, Document
-from llama_index.core.node_parser import SentenceSplitter, SemanticSplitterNodeParser
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from llama_index.core import VectorStoreIndex, Document, QueryBundle, StorageContext, load_index_from_storage
 from llama_index.llms.litellm import LiteLLM
+from loguru import logger
 from pydantic import BaseModel
 
+from cache import SemanticCache
+from embeddings import BatchedHuggingFaceEmbedding, BatchedSemanticSplitterNodeParser, preferred_dtype
+from history import HistoryStore, StoredMessage
 from prompts import text_qa_prompt, text_refine_prompt
 
+CACHE_DIR = "./cache_store"
+INDEX_DIR = "./index_store"
+INDEX_FINGERPRINT_PATH = os.path.join(INDEX_DIR, "documents.sha256")
+# Bump whenever the way nodes are built changes, so that persisted indexes are rebuilt
+INDEX_VERSION = 1
+EMBED_MODEL_NAME = "BAAI/bge-m3"
+SPLITTER_BUFFER_SIZE = 3
+SPLITTER_BREAKPOINT_PERCENTILE_THRESHOLD = 90
+HISTORY_DB_PATH = "./history.sqlite3"
+# Sent when a /chat stream fails after it started, followed by the error message
+STREAM_ERROR_MARKER = "\x1e"
+# A history write batch is flushed once it holds this many items or after this many seconds
+HISTORY_BATCH_SIZE = 32
+HISTORY_FLUSH_INTERVAL = 0.05
+# A failed history write batch is retried this many times in total, waiting longer after each attempt
+HISTORY_WRITE_ATTEMPTS = 3
+HISTORY_RETRY_DELAY = 0.5
+
 
 class Message(BaseModel):
 	role: str
@@ -24,7 +50,7 @@ class Message(BaseModel):
 class RequestBody(BaseModel):
 	conversation_id: str
 	user_message: str
-	messages: List[Message]
+	no_cache: bool = False
 
 
 class Server:
@@ -33,35 +59,139 @@ class Server:
 		self.index = None
 		self.embed_model = None
 		self.llm = None
-		self.conversations = []
+		self.query_engine = None
+		self.fingerprint = None
+		self.conversations: Dict[str, Dict] = {}
+		self.history = None
+		self.history_queue = None
+		self.history_writer = None
+		self.loop = None
+		self.cache = SemanticCache(threshold=0.92, ttl=3600)
+		# Exact repeats of a query skip the embedding forward pass
+		self.embed_query = functools.lru_cache(maxsize=1024)(self._embed_query)
 		load_dotenv()
 
 	async def on_startup(self):
-		self.embed_model = HuggingFaceEmbedding(model_name="BAAI/bge-m3")
+		self.history = HistoryStore(HISTORY_DB_PATH)
+		self.conversations = self.history.load()
+		self.loop = asyncio.get_running_loop()
+		self.history_queue = asyncio.Queue()
+		self.history_writer = asyncio.create_task(self._write_history())
+
+		self.embed_model = BatchedHuggingFaceEmbedding(
+			model_name=EMBED_MODEL_NAME,
+			embed_batch_size=2048,
+			forward_batch_size=128,
+			model_kwargs={"torch_dtype": preferred_dtype()}
+		)
 		documents = self.load_documents()
-		nodes = self.chunk_documents(documents, batch_size=32)
-
-		print("Building index...")
-		self.index = VectorStoreIndex(nodes, embed_model=self.embed_model)
+		self.fingerprint = self.index_fingerprint(documents)
+		self.cache.load(CACHE_DIR, self.fingerprint)
+
+		if self.stored_index_fingerprint() == self.fingerprint:
+			print("Loading index...")
+			storage_context = StorageContext.from_defaults(persist_dir=INDEX_DIR)
+			self.index = load_index_from_storage(storage_context, embed_model=self.embed_model)
+		else:
+			nodes = await self.chunk_documents(documents, batch_size=256, max_concurrency=4)
+
+			print("Building index...")
+			self.index = VectorStoreIndex(nodes, embed_model=self.embed_model)
+			self.index.storage_context.persist(persist_dir=INDEX_DIR)
+			with open(INDEX_FINGERPRINT_PATH, "w") as f:
+				f.write(self.fingerprint)
 
 		self.llm = LiteLLM(
 			"hosted_vllm/meltemi-vllm",
 			api_base=os.getenv("API_BASE"),
 			api_key=os.getenv("API_KEY")
 		)
+		self.query_engine = self.index.as_query_engine(
+			llm=self.llm, text_qa_prompt=text_qa_prompt, text_refine_prompt=text_refine_prompt, streaming=True
+		)
 
 	async def on_shutdown(self):
-		pass
+		self.cache.save(CACHE_DIR, self.fingerprint)
+		# Let the writer flush the remaining history items before closing the store
+		self._enqueue_history(None)
+		await self.history_writer
+		self.history.close()
+
+	def _enqueue_history(self, item: Optional[Tuple[str, Tuple]]):
+		# Messages are also stored from the threads that stream responses, where the queue cannot be used directly
+		self.loop.call_soon_threadsafe(self.history_queue.put_nowait, item)
+
+	async def _write_history(self):
+		"""Background task that persists queued conversations and messages in batches."""
+		done = False
+		while not done:
+			items = [await self.history_queue.get()]
+			deadline = self.loop.time() + HISTORY_FLUSH_INTERVAL
+			while len(items) < HISTORY_BATCH_SIZE and (timeout := deadline - self.loop.time()) > 0:
+				try:
+					items.append(await asyncio.wait_for(self.history_queue.get(), timeout))
+				except asyncio.TimeoutError:
+					break
+
+			# A None item is queued on shutdown and is the last one
+			if items[-1] is None:
+				done = True
+				items.pop()
+			if items:
+				await self._write_history_batch(items)
+
+	async def _write_history_batch(self, items: List[Tuple[str, Tuple]]):
+		conversations = {row[0]: row[1] for table, row in items if table == "conversations"}
+		messages = [row for table, row in items if table == "messages"]
+		# Every batch also writes the conversation rows of its messages
+		for conversation_id, _, _ in messages:
+			conversations.setdefault(conversation_id, self.conversations[conversation_id]["start_time"])
+
+		for attempt in range(1, HISTORY_WRITE_ATTEMPTS + 1):
+			try:
+				await asyncio.to_thread(self.history.write, list(conversations.items()), messages)
+				return
+			except Exception:
+				if attempt == HISTORY_WRITE_ATTEMPTS:
+					logger.exception(
+						"Lost {} conversation and {} message history rows of conversations {}",
+						len(conversations), len(messages), sorted(conversations)
+					)
+					return
+				logger.opt(exception=True).warning(
+					"Failed to persist history batch (attempt {}/{}), retrying", attempt, HISTORY_WRITE_ATTEMPTS
+				)
+				await asyncio.sleep(HISTORY_RETRY_DELAY * attempt)
 
 	def start_new_conversation(self) -> str:
 		"""Start a new conversation and return its unique ID."""
 		conversation_id = str(uuid.uuid4())
-		self.conversations.append({"id": conversation_id, "start_time": time.time(), "messages": []})
-		# Sort conversations by start time (latest first)
-		self.conversations.sort(key=lambda c: c["start_time"], reverse=True)
+		start_time = time.time()
+		self.conversations[conversation_id] = {"id": conversation_id, "start_time": start_time, "messages": []}
+		self._enqueue_history(("conversations", (conversation_id, start_time)))
 		return conversation_id
 
-	def chunk_documents(self, documents, batch_size=32):
+	@staticmethod
+	def index_fingerprint(documents) -> str:
+		"""Hash of the document texts and the chunking/embedding settings, used to detect when the persisted index is stale."""
+		digest = hashlib.sha256()
+		settings = (
+			INDEX_VERSION, EMBED_MODEL_NAME, preferred_dtype(),
+			SPLITTER_BUFFER_SIZE, SPLITTER_BREAKPOINT_PERCENTILE_THRESHOLD
+		)
+		digest.update(repr(settings).encode("utf-8") + b"\0")
+		for document in documents:
+			digest.update(document.text.encode("utf-8") + b"\0")
+		return digest.hexdigest()
+
+	@staticmethod
+	def stored_index_fingerprint() -> Optional[str]:
+		if not os.path.exists(INDEX_FINGERPRINT_PATH):
+			return None
+		with open(INDEX_FINGERPRINT_PATH) as f:
+			return f.read().strip()
+
+	async def chunk_documents(self, documents, batch_size=256, max_concurrency=4):
 		def batch(iterable, n=1):
 			it = iter(iterable)
 			from itertools import islice
@@ -69,69 +199,115 @@ class Server:
 				yield chunk
 
 
-		splitter = SemanticSplitterNodeParser(
-		    buffer_size=3, breakpoint_percentile_threshold=90, embed_model=self.embed_model
+		splitter = BatchedSemanticSplitterNodeParser(
+			buffer_size=SPLITTER_BUFFER_SIZE,
+			breakpoint_percentile_threshold=SPLITTER_BREAKPOINT_PERCENTILE_THRESHOLD,
+			embed_model=self.embed_model
 		)
 
-		nodes = []
-		for doc_batch in batch(documents, batch_size):
-			batch_nodes = splitter.get_nodes_from_documents(doc_batch)
-			nodes.extend(batch_nodes)
-		return nodes
+		# Run batches in worker threads so the Python-side splitting of one batch overlaps
+		# with the embedding forward pass of another, bounded to keep GPU memory in check
+		semaphore = asyncio.Semaphore(max_concurrency)
+
+		async def split(doc_batch):
+			async with semaphore:
+				return await asyncio.to_thread(splitter.get_nodes_from_documents, doc_batch)
+
+		batch_nodes = await asyncio.gather(*(split(doc_batch) for doc_batch in batch(documents, batch_size)))
+		return list(chain.from_iterable(batch_nodes))
 
 	@staticmethod
 	def load_documents():
-		def recipe_text_template(row: pd.Series) -> str:
-			template = (f"Η συνταγή για {row['name']} είναι ένα {row['Category']} που "
-						f"χρειάζεται τα εξής υλικά: {row['Ingredients']}. ")
-			if not pd.isna(row['Preparation Time']):
-				template += f"Έχει χρόνο προετοιμασίας {row['Preparation Time']} "
-			if not pd.isna(row['Total Time']):
-				template += f"και συνολικά παίρνει {row['Total Time']}. "
-			if not pd.isna(row['Number of Servings']):
-				template += f"Οι μερίδες που φτιάχνει είναι {row['Number of Servings']}. "
-			if not pd.isna(row['Keywords']):
-				template += f"Χαρακτηριστικές λέξεις που περιγράφουν αυτή τη συνταγή είναι: {row['Keywords']}."
-			if not pd.isna(row['Instructions']):
-				template += f"Ο τρόπος προετοιμασίας είναι ο εξής: {row['Instructions']}."
-			return template
-
-		recipes = pd.read_csv("hf://datasets/Depie/Recipes_Greek/recipes_greek.csv").apply(recipe_text_template, axis=1)
-		return [Document(text=t) for t in recipes.to_list()]
-
-	def serve(self, user_message: str, conversation_id: str) -> Union[str, Generator]:
-		# Add user message to conversation history
-		self.store_message(conversation_id, Message(role="user", content=user_message))
-
-		query_engine = self.index.as_query_engine(
-			llm=self.llm, text_qa_prompt=text_qa_prompt, text_refine_prompt=text_refine_prompt, streaming=False
+		def recipe_text_template(df: pd.DataFrame) -> pd.Series:
+			def optional(column: str, prefix: str, suffix: str = "") -> pd.Series:
+				return (prefix + df[column].astype(str) + suffix).where(df[column].notna(), "")
+
+			return ("Η συνταγή για " + df['name'].astype(str) + " είναι ένα " + df['Category'].astype(str) + " που "
+					"χρειάζεται τα εξής υλικά: " + df['Ingredients'].astype(str) + ". "
+					+ optional('Preparation Time', "Έχει χρόνο προετοιμασίας ", " ")
+					+ optional('Total Time', "και συνολικά παίρνει ", ". ")
+					+ optional('Number of Servings', "Οι μερίδες που φτιάχνει είναι ", ". ")
+					+ optional('Keywords', "Χαρακτηριστικές λέξεις που περιγράφουν αυτή τη συνταγή είναι: ", ".")
+					+ optional('Instructions', "Ο τρόπος προετοιμασίας είναι ο εξής: ", "."))
+
+		df = pd.read_csv(
+			"hf://datasets/Depie/Recipes_Greek/recipes_greek.csv",
+			engine="pyarrow",
+			usecols=[
+				'name', 'Category', 'Ingredients', 'Preparation Time', 'Total Time', 'Number of Servings',
+				'Keywords', 'Instructions'
+			]
 		)
+		# The pyarrow engine reads missing strings as None, keep them NaN so they render like the C engine did
+		recipes = recipe_text_template(df.where(df.notna(), np.nan))
+		# Identical recipe texts only add duplicate nodes to the index, keep each text once. This runs
+		# before the index fingerprint is computed, so indexes persisted with duplicates are rebuilt
+		return [Document(text=t) for t in dict.fromkeys(recipes.to_list())]
 
-		response = query_engine.query(user_message)
+	def _embed_query(self, query: str) -> Tuple[float, ...]:
+		return tuple(self.embed_model.get_query_embedding(query))
 
-		# Add assistant response to conversation history
-		assistant_message = Message(**{'role': "assistant", 'content': response.response})
-		self.store_message(conversation_id, assistant_message)
+	def serve(self, user_message: str, conversation_id: str, no_cache: bool = False) -> Iterator[str]:
+		# Add user message to conversation history
+		self.store_message(conversation_id, Message(role="user", content=user_message))
 
-		return response.response
+		# The query is embedded once, for both the semantic cache lookup and the retriever
+		query_embedding = list(self.embed_query(user_message))
+
+		# Answer near-duplicate questions from the semantic cache, skipping retrieval and the LLM
+		if not no_cache:
+			cached_response = self.cache.lookup(query_embedding)
+			if cached_response is not None:
+				self.store_message(conversation_id, Message(role="assistant", content=cached_response))
+				return iter([cached_response])
+
+		response = self.query_engine.query(QueryBundle(query_str=user_message, embedding=query_embedding))
+
+		# Starlette iterates this generator in its threadpool, concurrently with lookups on the event loop
+		# thread, so everything it touches after the stream (the semantic cache, the history) must be thread-safe
+		def stream_response() -> Iterator[str]:
+			tokens = []
+			completed = False
+			try:
+				for token in response.response_gen:
+					tokens.append(token)
+					yield token
+				completed = True
+			except Exception as e:
+				# The response has already started, so the error can only be reported inside the stream
+				logger.exception("Streaming the response of conversation {} failed", conversation_id)
+				yield f"{STREAM_ERROR_MARKER}{e}"
+			finally:
+				# Add assistant response to conversation history, also when the stream was cut short
+				assistant_message = Message(**{'role': "assistant", 'content': "".join(tokens)})
+				self.store_message(conversation_id, assistant_message)
+
+			if completed and not no_cache:
+				try:
+					self.cache.add(query_embedding, assistant_message.content)
+				except Exception:
+					logger.exception("Failed to cache the response of conversation {}", conversation_id)
+
+		return stream_response()
+
+	def _lookup_conversation(self, conversation_id: str) -> Dict:
+		try:
+			return self.conversations[conversation_id]
+		except KeyError:
+			raise ValueError(f"Conversation ID {conversation_id} not found.")
 
 	def store_message(self, conversation_id: str, message: Message):
 		"""Store a message in the conversation history."""
-		for conversation in self.conversations:
-			if conversation["id"] == conversation_id:
-				conversation["messages"].append(message.model_dump())
-				return
-		raise ValueError(f"Conversation ID {conversation_id} not found.")
+		self._lookup_conversation(conversation_id)["messages"].append(StoredMessage(message.role, message.content))
+		self._enqueue_history(("messages", (conversation_id, message.role, message.content)))
 
-	def get_conversation(self, conversation_id: str) -> List[Message]:
-		# TODO make self.conversations a dict for faster lookup
-		for conversation in self.conversations:
-			if conversation["id"] == conversation_id:
-				return conversation["messages"]
-		raise ValueError(f"Conversation ID {conversation_id} not found.")
+	def get_conversation(self, conversation_id: str) -> List[Dict]:
+		return [{"role": m.role, "content": m.content} for m in self._lookup_conversation(conversation_id)["messages"]]
 
 	def get_all_conversations(self) -> List[Dict]:
-		return [{"id": c["id"], "start_time": c["start_time"]} for c in self.conversations]
+		# Sort conversations by start time (latest first)
+		conversations = sorted(self.conversations.values(), key=lambda c: c["start_time"], reverse=True)
+		return [{"id": c["id"], "start_time": c["start_time"]} for c in conversations]
 
 
 server = Server()
@@ -144,7 +320,7 @@ async def lifespan(app: FastAPI):
 	await server.on_shutdown()
 
 
-app = FastAPI(docs_url="/docs", redoc_url=None, lifespan=lifespan)
+app = FastAPI(docs_url="/docs", redoc_url=None, lifespan=lifespan, default_response_class=ORJSONResponse)
 
 
 @app.post("/chat")
@@ -153,8 +329,8 @@ async def query_pipeline(body: RequestBody):
 	try:
 		conversation_id = body.conversation_id
 		user_message = body.user_message
-		response_gen = server.serve(user_message, conversation_id)
-		return {"response": "".join(response_gen)}
+		response_gen = server.serve(user_message, conversation_id, no_cache=body.no_cache)
+		return StreamingResponse(response_gen, media_type="text/plain")
 	except Exception as e:
 		raise HTTPException(status_code=500, detail=str(e))
 